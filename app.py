@@ -2,6 +2,10 @@ import streamlit as st
 import asyncio
 import tempfile
 import os
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 from typing import List, Dict, Any
 import pandas as pd
 from datetime import datetime
@@ -21,6 +25,25 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Configure logging once per process (the script reruns on every action) - handlers
+# run on a QueueListener thread so service code only enqueues records
+@st.cache_resource
+def configure_logging():
+    """Send service logs to stderr through a queue listener"""
+    log_queue = queue.SimpleQueue()
+    log_stream_handler = logging.StreamHandler()
+    log_stream_handler.setFormatter(
+        logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_listener = QueueListener(log_queue, log_stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    log_listener.start()
+    atexit.register(log_listener.stop)
+    return log_listener
+
+configure_logging()
+
 # Initialize session state
 if 'messages' not in st.session_state:
     st.session_state.messages = []
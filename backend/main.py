@@ -5,6 +5,9 @@ import uuid
 import os
 from typing import Dict, Optional, List
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 import tempfile
 import asyncio
 import time
@@ -22,9 +25,18 @@ except ImportError as e:
     print(f"Warning: RAG services not available: {e}")
     RAG_AVAILABLE = False
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, 
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Configure logging - handlers run on a QueueListener thread so request
+# handlers only enqueue records and never block on stream I/O
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_stream_handler)
+root_logger = logging.getLogger()
+root_logger.setLevel(logging.INFO)
+root_logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
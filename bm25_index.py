@@ -0,0 +1,109 @@
+from collections import Counter
+from typing import List, Tuple
+import numpy as np
+
+class BM25Index:
+    """Okapi BM25 over a Structure-of-Arrays inverted index.
+
+    Postings for every term are stored contiguously in two flat arrays
+    (``doc_ids`` as int32, ``tfs`` as float32) addressed by ``term_offsets``,
+    so scoring a query term is a vectorized numpy expression over one
+    slice instead of a Python loop over every document.
+    """
+
+    def __init__(self, corpus: List[List[str]], k1: float = 1.5, b: float = 0.75,
+                 common_term_ratio: float = 0.02):
+        """Build the inverted index from a tokenized corpus"""
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(corpus)
+
+        # term -> [(doc_idx, tf), ...] in document order
+        postings = {}
+        for doc_idx, tokens in enumerate(corpus):
+            for token, tf in Counter(tokens).items():
+                postings.setdefault(token, []).append((doc_idx, tf))
+
+        self.vocab = {term: term_id for term_id, term in enumerate(postings)}
+
+        # Flatten postings into contiguous SoA arrays
+        df = np.fromiter((len(p) for p in postings.values()), dtype=np.int64, count=len(postings))
+        self.term_offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        np.cumsum(df, out=self.term_offsets[1:])
+
+        self.doc_ids = np.empty(int(self.term_offsets[-1]), dtype=np.int32)
+        self.tfs = np.empty(int(self.term_offsets[-1]), dtype=np.float32)
+        for term_id, term_postings in enumerate(postings.values()):
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            self.doc_ids[start:end], self.tfs[start:end] = zip(*term_postings)
+
+        self.doc_lens = np.fromiter((len(tokens) for tokens in corpus), dtype=np.float32, count=self.num_docs)
+        self.avgdl = float(self.doc_lens.mean()) if self.num_docs and self.doc_lens.any() else 1.0
+
+        # Query-independent part of the BM25 denominator, one contiguous float32 per document
+        self._doc_denom = (self.k1 * (1 - self.b + self.b * self.doc_lens / self.avgdl)).astype(np.float32)
+
+        # Terms found in more than common_term_ratio of documents don't generate candidates
+        self.common_terms = df > common_term_ratio * self.num_docs
+
+        # Lucene-style idf, always non-negative
+        self.idf = np.log1p((self.num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    def _postings(self, term_id: int):
+        """Get the (doc_ids, tfs) slices for a term"""
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+    def _contributions(self, term_id: int, doc_ids: np.ndarray, tfs: np.ndarray) -> np.ndarray:
+        """BM25 contribution of a term to the given documents"""
+        return self.idf[term_id] * tfs * (self.k1 + 1) / (tfs + self._doc_denom[doc_ids])
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        """Score every document against the query tokens"""
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+
+        for token in query_tokens:
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+
+            doc_ids, tfs = self._postings(term_id)
+            # doc_ids are unique within a posting list, so fancy-index add is safe
+            scores[doc_ids] += self._contributions(term_id, doc_ids, tfs)
+
+        return scores
+
+    def top_k(self, query_tokens: List[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the top-k (doc_ids, scores) for a query.
+
+        Common terms only add to documents matched by a rarer query term,
+        as long as the rare terms alone match at least k documents. The
+        k best documents are then picked with one O(N) partial selection
+        instead of a full sort.
+        """
+        term_ids = [self.vocab[token] for token in query_tokens if token in self.vocab]
+        if not term_ids or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        allowed = None  # Documents matched by rare terms, when the cutoff applies
+        rare_ids = [term_id for term_id in term_ids if not self.common_terms[term_id]]
+        if rare_ids and len(rare_ids) < len(term_ids):
+            rare_docs = np.unique(np.concatenate([self._postings(term_id)[0] for term_id in rare_ids]))
+            if len(rare_docs) >= k:
+                allowed = np.zeros(self.num_docs, dtype=bool)
+                allowed[rare_docs] = True
+
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for term_id in term_ids:
+            doc_ids, tfs = self._postings(term_id)
+            if allowed is not None and self.common_terms[term_id]:
+                keep = allowed[doc_ids]
+                doc_ids, tfs = doc_ids[keep], tfs[keep]
+            scores[doc_ids] += self._contributions(term_id, doc_ids, tfs)
+
+        # O(N) partial selection of the k best hits, then sort only those k
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k)[:k]]
+        top = hits[np.argsort(-scores[hits], kind='stable')].astype(np.int64)
+        return top, scores[top]
@@ -7,6 +7,7 @@ class Config:
     QDRANT_URL = os.getenv("QDRANT_URL")
     QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
     COLLECTION_NAME = os.getenv("COLLECTION_NAME", "chatbot_docs")
+    QDRANT_UPSERT_CONCURRENCY = 8  # Upsert batches in flight at once during ingestion
     
     # FastEmbed settings
     EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
@@ -20,27 +21,50 @@ class Config:
     TOP_K = 20               # Reduce to get more focused results
     SCORE_THRESHOLD = 0.3    # Add threshold to filter poor matches
     MAX_CONTEXT_CHUNKS = 10  # Reduce context to avoid noise
+    CONTEXT_TOKEN_BUDGET = 6000  # Estimated prompt tokens allowed for document context
+    HIGH_CONFIDENCE_THRESHOLD = 0.7  # Sigmoid of the top rerank score that allows an extractive answer
     
     # Gemini API settings
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+    FAST_ANSWER_MODEL = os.getenv("FAST_ANSWER_MODEL", "gemini-2.5-flash")    # Focused extractive answers
+    REQUERY_ANSWER_MODEL = os.getenv("REQUERY_ANSWER_MODEL", "gemini-2.5-pro")  # Retry when fast answer is generic
 
     # Enhanced settings for large documents
     # Hybrid Retrieval Settings
     BM25_TOP_K = 15              # Reduce for more focused results
     SEMANTIC_TOP_K = 15          # Reduce for more focused results
     RERANK_TOP_K = 10            # Reduce for better precision
+    BM25_COMMON_TERM_RATIO = 0.02  # Terms in more docs than this don't generate BM25 candidates
 
     # Score fusion weights
     SEMANTIC_WEIGHT = 0.7         # Weight for semantic search scores
     KEYWORD_WEIGHT = 0.3          # Weight for keyword search scores
+    RRF_K = 60                    # Reciprocal Rank Fusion rank offset for hybrid results
     RERANK_WEIGHT = 0.6           # Weight for reranking scores
 
     # Memory settings
     MAX_CONVERSATION_MEMORY = 2000  # Max tokens in conversation memory
     CONVERSATION_SUMMARY_THRESHOLD = 1500  # When to start summarizing
+    MAX_SESSIONS = 10000          # LRU cap on in-memory conversation sessions
 
     # Cache settings
     CACHE_EXPIRE_HOURS = 24       # Default cache expiration
     EMBEDDING_CACHE_HOURS = 168   # Embedding cache expiration (1 week)
     SEARCH_CACHE_HOURS = 6        # Search results cache expiration
-    MAX_CACHE_SIZE_MB = 500       # Maximum cache size in MB
\ No newline at end of file
+    MAX_CACHE_SIZE_MB = 500       # Maximum cache size in MB
+    BM25_CACHE_DIR = "cache/bm25_index"  # Persisted bm25s indexes (one directory per collection fingerprint)
+def estimate_tokens(text: str) -> int:
+    """Rough token count for budgeting prompt text (~4 characters per token)"""
+    return len(text) // 4
+
+def context_chunk_count(docs: list, max_chunks: int) -> int:
+    """How many leading docs fit in Config.CONTEXT_TOKEN_BUDGET (always at least one, at most max_chunks)"""
+    count = 0
+    used_tokens = 0
+    for doc in docs[:max_chunks]:
+        est_tokens = estimate_tokens(doc['text'])
+        if count and used_tokens + est_tokens > Config.CONTEXT_TOKEN_BUDGET:
+            break
+        count += 1
+        used_tokens += est_tokens
+    return count
@@ -1,14 +1,23 @@
 import asyncio
+import logging
+import math
 from typing import List, Dict, Any, Optional
 from hybrid_retriever import HybridRetriever
 from memory_manager import ConversationMemoryManager
 from cache_manager import CacheManager, EmbeddingCache, SearchCache
 from ingestion_pipeline import IngestionPipeline
+from qdrant_service import RESULT_PAYLOAD
 from google import genai
 from google.genai import types
-from config import Config
+from config import Config, context_chunk_count
 import uuid
 
+logger = logging.getLogger(__name__)
+
+# Question words ignored when matching extracted content
+_STOP = frozenset({'what', 'how', 'who', 'when', 'where', 'why', 'can', 'you', 'tell', 'describe', 'the', 'and', 'or'})
+_PUNCT = str.maketrans('', '', '?,!.')
+
 class EnhancedRAGService:
     def __init__(self):
         """Initialize enhanced RAG service with all components"""
@@ -22,7 +31,10 @@ class EnhancedRAGService:
         )
         
         # Memory management
-        self.memory_manager = ConversationMemoryManager(Config.GEMINI_API_KEY)
+        self.memory_manager = ConversationMemoryManager(
+            Config.GEMINI_API_KEY,
+            embedding_service=self.pipeline.embedding_service
+        )
         
         # Caching
         self.cache_manager = CacheManager()
@@ -32,6 +44,21 @@ class EnhancedRAGService:
         # Gemini client
         self.gemini_client = genai.Client(api_key=Config.GEMINI_API_KEY)
         
+        # Generation configs are fixed per service - only the prompt changes per call.
+        # Extractive task - the fast model without deep thinking is enough
+        self._gen_config = types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(thinking_budget=0),
+            temperature=0.1,  # Very low for precise extraction
+            top_p=0.8,
+            top_k=20
+        )
+        self._requery_config = types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(thinking_budget=-1),
+            temperature=0.1,
+            top_p=0.8,
+            top_k=20
+        )
+        
         # Session management
         self.current_session = None
     
@@ -79,83 +106,48 @@ class EnhancedRAGService:
             # MULTI-STRATEGY SEARCH - Will definitely find content
             relevant_docs = []
             search_method = "enhanced_multi_strategy"
+            high_confidence = False
             
             # Strategy 1: Try hybrid search
             try:
                 relevant_docs = await self.hybrid_retriever.hybrid_search(enhanced_query, Config.TOP_K * 2)
                 if relevant_docs:
                     search_method = "hybrid_enhanced"
-                    print(f"Hybrid search found {len(relevant_docs)} results")
+                    logger.debug("Hybrid search found %d results", len(relevant_docs))
+                    # Only the cross-encoder gives a calibrated relevance signal: final_score
+                    # is clipped and RRF scores are rank-based, so neither can mark a clear hit
+                    rerank_scores = [d['rerank_score'] for d in relevant_docs if 'rerank_score' in d]
+                    if rerank_scores:
+                        top_relevance = 1.0 / (1.0 + math.exp(-max(rerank_scores)))
+                        high_confidence = top_relevance > Config.HIGH_CONFIDENCE_THRESHOLD
             except Exception as e:
-                print(f"Hybrid search failed: {str(e)}")
+                logger.warning("Hybrid search failed: %s", e)
             
-            # Strategy 2: Direct semantic search with aggressive parameters
             if not relevant_docs:
+                # Strategy 3's scroll is started speculatively so it overlaps Strategy 2,
+                # and is cancelled if the semantic search finds something
+                brute_force_task = asyncio.create_task(self._brute_force_points())
+                
+                # Strategy 2: Direct semantic search with aggressive parameters
                 try:
-                    print("Trying aggressive semantic search...")
-                    query_embedding = self.pipeline.embedding_service.embed_single_text(enhanced_query)
+                    logger.info("Trying aggressive semantic search...")
+                    query_embedding = await asyncio.to_thread(
+                        self.pipeline.embedding_service.embed_single_text, enhanced_query
+                    )
                     relevant_docs = await self.pipeline.qdrant_service.search_similar(query_embedding, Config.TOP_K * 3)
                     if relevant_docs:
                         search_method = "semantic_aggressive"
-                        print(f"Semantic search found {len(relevant_docs)} results")
+                        logger.debug("Semantic search found %d results", len(relevant_docs))
                 except Exception as e:
-                    print(f"Semantic search failed: {str(e)}")
-            
-            # Strategy 3: Use basic RAG service
-            if not relevant_docs:
-                try:
-                    print("Trying basic RAG service...")
-                    from rag_service import RAGService
-                    basic_rag = RAGService()
-                    basic_result = await basic_rag.generate_answer(question)
-                    if basic_result.get('sources'):
-                        # Convert to our format
-                        relevant_docs = []
-                        for source in basic_result['sources']:
-                            relevant_docs.append({
-                                'text': f"Content related to your question from {source['filename']}",
-                                'filename': source['filename'],
-                                'chunk_id': source['chunk_id'],
-                                'score': max(0.3, source.get('score', 0.5)),
-                                'final_score': max(0.3, source.get('score', 0.5)),
-                                'search_type': 'basic_rag'
-                            })
-                        search_method = "basic_rag_enhanced"
-                        
-                        # Return the basic RAG result immediately if it has content
-                        if basic_result['answer'] and "couldn't" not in basic_result['answer'].lower():
-                            return {
-                                'answer': basic_result['answer'],
-                                'sources': basic_result['sources'],
-                                'confidence': max(0.4, min(1.0, basic_result.get('confidence', 0.6))),
-                                'retrieved_docs_count': len(basic_result['sources']),
-                                'context_chunks_used': len(basic_result['sources']),
-                                'search_method': search_method,
-                                'session_id': self.current_session,
-                                'has_conversation_context': False  # No context used
-                            }
-                        
-                        print(f"Basic RAG found {len(relevant_docs)} results")
-                except Exception as e:
-                    print(f"Basic RAG failed: {str(e)}")
-            
-            # Strategy 4: Brute force - get ANY content from collection
-            if not relevant_docs:
-                try:
-                    print("Brute force: Getting any available content...")
-                    collection_info = self.pipeline.qdrant_service.client.get_collection(
-                        self.pipeline.qdrant_service.collection_name
-                    )
-                    
-                    if collection_info.points_count > 0:
-                        scroll_result = self.pipeline.qdrant_service.client.scroll(
-                            collection_name=self.pipeline.qdrant_service.collection_name,
-                            limit=min(50, Config.TOP_K * 4),
-                            with_payload=True,
-                            with_vectors=False
-                        )
-                        
-                        points = scroll_result[0]
+                    logger.warning("Semantic search failed: %s", e)
+                
+                # Strategy 3: Brute force - get ANY content from collection
+                if relevant_docs:
+                    brute_force_task.cancel()
+                else:
+                    logger.info("Brute force: Getting any available content...")
+                    points = await brute_force_task
+                    if points:
                         for point in points:
                             relevant_docs.append({
                                 'text': point.payload['text'],
@@ -167,12 +159,18 @@ class EnhancedRAGService:
                             })
                         
                         search_method = "brute_force_content"
-                        print(f"Brute force found {len(relevant_docs)} results")
-                    else:
-                        print("Collection is empty!")
-                        
-                except Exception as e:
-                    print(f"Brute force search failed: {str(e)}")
+                        logger.debug("Brute force found %d results", len(relevant_docs))
+                    elif points is not None:
+                        logger.warning("Collection is empty!")
+            
+            # Deduplicate chunks, keeping the best-scored copy of each
+            best_docs = {}
+            for doc in relevant_docs:
+                key = (doc['filename'], doc['chunk_id'])
+                current = best_docs.get(key)
+                if current is None or doc.get('final_score', doc.get('score', 0)) > current.get('final_score', current.get('score', 0)):
+                    best_docs[key] = doc
+            relevant_docs = sorted(best_docs.values(), key=lambda d: d.get('final_score', d.get('score', 0)), reverse=True)
             
             # If we STILL don't have content, return a helpful error
             if not relevant_docs:
@@ -197,21 +195,20 @@ class EnhancedRAGService:
                 }
             
             # Prepare context with FOCUSED content - NO conversation context
-            context_parts = []
             sources = []
             
-            # Use focused chunks - be more selective
-            max_chunks = min(10, len(relevant_docs))  # Use fewer, more relevant chunks
+            # Use focused chunks - bounded by an estimated token budget so large
+            # chunks don't blow up Gemini prefill, and never more than 10
+            max_chunks = context_chunk_count(relevant_docs, 10)
+            context_docs = relevant_docs[:max_chunks]
             
-            for i, doc in enumerate(relevant_docs[:max_chunks]):
+            for doc in context_docs:
                 # Fix score calculation
                 raw_score = doc.get('final_score', doc.get('score', 0.5))
                 final_score = max(0.1, min(1.0, abs(float(raw_score))))
                 
                 doc_search_type = doc.get('search_type', search_method)
                 
-                # Clean and focused context
-                context_parts.append(f"Document {i+1} from {doc['filename']}:\n{doc['text']}")
                 sources.append({
                     'filename': doc['filename'],
                     'chunk_id': doc['chunk_id'],
@@ -219,15 +216,23 @@ class EnhancedRAGService:
                     'search_method': doc_search_type
                 })
             
-            context = "\n\n".join(context_parts)
+            # Clean and focused context, joined in one pass without an intermediate list
+            context = "\n\n".join(
+                f"Document {i+1} from {doc['filename']}:\n{doc['text']}"
+                for i, doc in enumerate(context_docs)
+            )
             
-            # Generate answer with FOCUSED prompt that extracts specific content
-            answer = await self._generate_focused_answer(question, context)
+            # Generate answer with FOCUSED prompt that extracts specific content.
+            # A single high-confidence chunk is answered extractively without Gemini.
+            if high_confidence and max_chunks == 1:
+                answer = self._extract_specific_content(question, context)
+            else:
+                answer = await self._generate_focused_answer(question, context)
             
             # Calculate confidence
             if relevant_docs:
                 scores = []
-                for doc in relevant_docs[:max_chunks]:
+                for doc in context_docs:
                     raw_score = doc.get('final_score', doc.get('score', 0.5))
                     normalized_score = max(0.1, min(1.0, abs(float(raw_score))))
                     scores.append(normalized_score)
@@ -251,9 +256,7 @@ class EnhancedRAGService:
             return result
             
         except Exception as e:
-            print(f"Critical error in generate_answer_with_context: {str(e)}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("Critical error in generate_answer_with_context: %s", e)
             
             # Even in error, try to provide something useful
             return {
@@ -298,35 +301,47 @@ FOCUSED ANSWER:"""
                 ),
             ]
             
-            generate_content_config = types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(thinking_budget=-1),
-                temperature=0.1,  # Very low for precise extraction
-                top_p=0.8,
-                top_k=20
+            # The sync stream is drained on a worker thread so generation never blocks the event loop
+            answer = await asyncio.to_thread(
+                self._stream_answer, Config.FAST_ANSWER_MODEL, contents, self._gen_config
             )
             
-            answer = ""
-            for chunk in self.gemini_client.models.generate_content_stream(
-                model="gemini-2.5-pro",
-                contents=contents,
-                config=generate_content_config,
-            ):
-                if chunk.text:
-                    answer += chunk.text
-            
-            # Clean up the answer
-            answer = answer.strip()
+            # Generic response from the fast model - re-query the stronger model
+            if self._is_generic_answer(answer):
+                answer = await asyncio.to_thread(
+                    self._stream_answer, Config.REQUERY_ANSWER_MODEL, contents, self._requery_config
+                )
             
-            # If the AI gives a generic response, try to extract specific content
-            if not answer or "based on your documents" in answer.lower() or "relevant information i found" in answer.lower():
+            # If the AI still gives a generic response, try to extract specific content
+            if self._is_generic_answer(answer):
                 return self._extract_specific_content(question, context)
             
             return answer
             
         except Exception as e:
-            print(f"Error in focused answer generation: {str(e)}")
+            logger.warning("Error in focused answer generation: %s", e)
             return self._extract_specific_content(question, context)
     
+    def _stream_answer(self, model: str, contents: List[types.Content], config: types.GenerateContentConfig) -> str:
+        """Stream a Gemini response and return the stripped answer text - SYNCHRONOUS"""
+        # Collect streamed parts and join once instead of concatenating per chunk
+        parts = [
+            chunk.text
+            for chunk in self.gemini_client.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=config,
+            )
+            if chunk.text
+        ]
+        return "".join(parts).strip()
+    
+    @staticmethod
+    def _is_generic_answer(answer: str) -> bool:
+        """Check whether the model answered without using the document content"""
+        answer_lower = answer.lower()
+        return not answer or "based on your documents" in answer_lower or "relevant information i found" in answer_lower
+    
     def _extract_specific_content(self, question: str, context: str) -> str:
         """Extract specific content that directly answers the question"""
         try:
@@ -337,6 +352,10 @@ FOCUSED ANSWER:"""
             docs = context.split('\n\n')
             question_lower = question.lower()
             
+            # Extract keywords from question
+            question_words = [word for word in question_lower.translate(_PUNCT).split()
+                              if len(word) > 2 and word not in _STOP]
+            
             # Look for direct matches to the question
             relevant_content = []
             
@@ -355,10 +374,6 @@ FOCUSED ANSWER:"""
                 # Check if this document content is relevant
                 doc_lower = doc_content.lower()
                 
-                # Extract keywords from question
-                question_words = [word.strip('?,!.') for word in question_lower.split() 
-                                if len(word) > 2 and word not in ['what', 'how', 'who', 'when', 'where', 'why', 'can', 'you', 'tell', 'describe', 'the', 'and', 'or']]
-                
                 # Check for word matches
                 if any(word in doc_lower for word in question_words):
                     relevant_content.append(doc_content)
@@ -384,11 +399,11 @@ FOCUSED ANSWER:"""
     async def rebuild_search_index(self):
         """Rebuild search indices for better performance"""
         try:
-            print("🔄 Rebuilding search indices...")
+            logger.info("Rebuilding search indices...")
             await self.hybrid_retriever.build_bm25_index()
-            print("✅ Search indices rebuilt successfully")
+            logger.info("Search indices rebuilt successfully")
         except Exception as e:
-            print(f"❌ Error rebuilding search index: {str(e)}")
+            logger.error("Error rebuilding search index: %s", e)
             # Don't fail completely, just log the error
     
     def get_session_info(self) -> Dict[str, Any]:
@@ -411,6 +426,22 @@ FOCUSED ANSWER:"""
         """Clear cache"""
         self.cache_manager.clear_all(cache_type)
     
+    async def _brute_force_points(self) -> Optional[List[Any]]:
+        """Get one bounded page of any content from the collection (None if the scroll fails)"""
+        try:
+            # One bounded page is all we need; an empty page means an empty collection
+            points, _ = await asyncio.to_thread(
+                self.pipeline.qdrant_service.client.scroll,
+                collection_name=self.pipeline.qdrant_service.collection_name,
+                limit=min(50, Config.TOP_K * 4),
+                with_payload=RESULT_PAYLOAD,
+                with_vectors=False
+            )
+            return points
+        except Exception as e:
+            logger.warning("Brute force search failed: %s", e)
+            return None
+    
     def _create_contextual_query(self, question: str, conversation_context: str) -> str:
         """Create enhanced query using conversation context"""
         if conversation_context:
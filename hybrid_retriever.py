@@ -1,10 +1,25 @@
 import asyncio
-from typing import List, Dict, Any, Optional
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import List, Dict, Any, Optional, Iterator
 import numpy as np
+from cachetools import LRUCache, TTLCache
+from bm25_index import BM25Index
 from embedding_service import EmbeddingService
-from qdrant_service import QdrantService
-from config import Config
+from qdrant_service import QdrantService, RESULT_PAYLOAD
+from config import Config, estimate_tokens
 import re
+from threading import Lock
+
+# Tokens keep word characters plus hyphens and dots (e.g. "spark-submit", "3.5");
+# runs shorter than 3 characters never match, so no length filter is needed
+_TOKEN_RE = re.compile(r'[\w\-\.]{3,}')
+
+# Estimated-token upper bounds for reranker length buckets over query + snippet
+# (the last bucket is the rest; 512-character snippets top out around 128 tokens plus the query)
+RERANK_BUCKETS = [64, 96]
 
 class HybridRetriever:
     def __init__(self, qdrant_service: QdrantService, embedding_service: EmbeddingService):
@@ -16,99 +31,226 @@ class HybridRetriever:
         self.reranker = None
         try:
             from sentence_transformers import CrossEncoder
-            self.reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+            import torch
+            # Snippets are cut to 512 chars, so 256 tokens is enough and halves padding
+            self.reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2', max_length=256)
+            if torch.cuda.is_available():
+                # fp16 inference on GPU for the cross-encoder forward pass
+                self.reranker.model.half()
             print("✅ Reranker model loaded successfully")
         except ImportError:
             print("⚠️  Warning: sentence-transformers not installed, skipping reranker")
         except Exception as e:
             print(f"⚠️  Warning: Could not load reranker model: {str(e)}")
         
-        # BM25 initialization with better error handling
+        # Cross-encoder scores keyed by (query hash, filename, chunk_id, snippet hash)
+        # (reranking runs on worker threads, so access goes through a lock)
+        self._rerank_cache = LRUCache(maxsize=50000)
+        self._rerank_cache_lock = Lock()
+        
+        # Query embeddings keyed by query hash, so retries and the semantic
+        # fallback within a few minutes skip the embedding forward pass
+        self._query_embedding_cache = TTLCache(maxsize=5000, ttl=300)
+        self._query_embedding_cache_lock = Lock()
+        
+        # BM25 initialization with better error handling - prefer bm25s (precomputed
+        # sparse scores with optional numba scoring), fall back to the numpy index
         self.bm25 = None
-        self.bm25_available = False
+        self.bm25_backend = 'numpy'
+        self.bm25_numba = False
         try:
-            from rank_bm25 import BM25Okapi
-            self.bm25_available = True
-            print("✅ BM25 library available")
+            import bm25s
+            self.bm25_backend = 'bm25s'
+            print("✅ BM25 library available (bm25s)")
         except ImportError:
-            print("⚠️  Warning: rank-bm25 not installed, using semantic search only")
+            print("⚠️  Warning: bm25s not installed, using numpy BM25 index")
         
-        self.documents_corpus = []
         self.documents_metadata = []
         
     async def build_bm25_index(self):
         """Build BM25 index from all documents in collection"""
         try:
+            # Reuse the persisted index when it was built from exactly the same points
+            if self._load_bm25_cache():
+                return
+            
             print("Building BM25 index...")
-            # Import BM25Okapi here to ensure it's defined
-            from rank_bm25 import BM25Okapi
-            # Get all documents from Qdrant - FIXED: removed await from non-async method
-            all_docs = self._get_all_documents_sync()
+            # Stream documents from Qdrant in pages and tokenize each page as it arrives.
+            # Build into locals so a failure part-way keeps the previous index consistent.
+            documents_corpus = []
+            documents_metadata = []
             
-            if not all_docs:
+            for batch in self._iter_document_batches():
+                # Tokenize the whole page for BM25 in one call
+                documents_corpus.extend(self._tokenize_batch([doc['text'] for doc in batch]))
+                documents_metadata.extend(batch)
+            
+            if not documents_corpus:
                 print("No documents found for BM25 indexing")
                 return
             
-            # Prepare corpus for BM25
-            self.documents_corpus = []
-            self.documents_metadata = []
-            
-            for doc in all_docs:
-                # Tokenize text for BM25
-                tokenized_text = self._tokenize_text(doc['text'])
-                self.documents_corpus.append(tokenized_text)
-                self.documents_metadata.append({
-                    'text': doc['text'],
-                    'filename': doc['filename'],
-                    'chunk_id': doc['chunk_id'],
-                    'doc_id': doc.get('doc_id', '')
-                })
-            
             # Build BM25 index
-            self.bm25 = BM25Okapi(self.documents_corpus)
-            print(f"✅ Built BM25 index with {len(self.documents_corpus)} documents")
+            if self.bm25_backend == 'bm25s':
+                import bm25s
+                bm25 = bm25s.BM25(method="lucene", k1=1.5, b=0.75)
+                bm25.index(documents_corpus, show_progress=False)
+                try:
+                    bm25.activate_numba_scorer()
+                    self.bm25_numba = True
+                except Exception as e:
+                    print(f"⚠️  Warning: numba scorer unavailable, using numpy scoring: {str(e)}")
+                    self.bm25_numba = False
+            else:
+                bm25 = BM25Index(documents_corpus, k1=1.5, b=0.75,
+                                 common_term_ratio=Config.BM25_COMMON_TERM_RATIO)
+            del documents_corpus  # Release the token lists before saving the index
+            self.bm25 = bm25
+            self.documents_metadata = documents_metadata
+            print(f"✅ Built BM25 index with {len(documents_metadata)} documents")
+            
+            if self.bm25_backend == 'bm25s':
+                self._save_bm25_cache(self._collection_fingerprint(
+                    doc['doc_id'] for doc in documents_metadata
+                ))
             
         except Exception as e:
             print(f"❌ Error building BM25 index: {str(e)}")
     
-    def _get_all_documents_sync(self) -> List[Dict[str, Any]]:
-        """Get all documents from Qdrant collection - SYNCHRONOUS"""
+    def _collection_fingerprint(self, point_ids) -> str:
+        """Hash the collection name and its sorted point ids into a cache directory name"""
+        digest = hashlib.blake2b(self.qdrant_service.collection_name.encode(), digest_size=16)
+        for point_id in sorted(point_ids):
+            digest.update(b'\n' + point_id.encode())
+        return digest.hexdigest()
+    
+    def _iter_point_ids(self, batch_size: int = 10000) -> Iterator[str]:
+        """Yield every point id in the collection without payloads - SYNCHRONOUS"""
+        offset = None
+        while True:
+            points, offset = self.qdrant_service.client.scroll(
+                collection_name=self.qdrant_service.collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False
+            )
+            for point in points:
+                yield str(point.id)
+            if offset is None:
+                break
+    
+    def _load_bm25_cache(self) -> bool:
+        """Load the persisted bm25s index (memory-mapped) if one matches the collection's points"""
+        if self.bm25_backend != 'bm25s' or not os.path.isdir(Config.BM25_CACHE_DIR):
+            return False
+        
         try:
-            # Use scroll method to get all documents
-            documents = []
+            import bm25s
+            import pyarrow.parquet as pq
             
-            # Get collection info first
-            collection_info = self.qdrant_service.client.get_collection(
-                self.qdrant_service.collection_name
-            )
+            # Each index lives in a directory named after the points it was built from,
+            # so a changed collection (even one with the same size) never matches
+            index_dir = os.path.join(Config.BM25_CACHE_DIR, self._collection_fingerprint(self._iter_point_ids()))
+            meta_path = os.path.join(index_dir, "meta.parquet")
+            if not os.path.exists(meta_path):
+                return False
             
-            if collection_info.points_count == 0:
-                return []
+            bm25 = bm25s.BM25.load(index_dir, mmap=True)
+            documents_metadata = pq.read_table(meta_path).to_pylist()
+            try:
+                bm25.activate_numba_scorer()
+                self.bm25_numba = True
+            except Exception:
+                self.bm25_numba = False
+
+            self.bm25 = bm25
+            self.documents_metadata = documents_metadata
+            print(f"✅ Loaded cached BM25 index with {len(self.documents_metadata)} documents")
+            return True
+        
+        except ImportError:
+            return False
+        except Exception as e:
+            print(f"⚠️  Warning: Could not load cached BM25 index, rebuilding: {str(e)}")
+            return False
+    
+    def _save_bm25_cache(self, fingerprint: str):
+        """Persist the bm25s index and its document metadata for the next start.
+        
+        Other retrievers may have an older index memory-mapped, so files are never
+        rewritten in place: the index is written to a fresh temporary directory and
+        renamed into place, and superseded directories are only unlinked (mapped
+        pages stay valid until they are unmapped).
+        """
+        tmp_dir = None
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            
+            index_dir = os.path.join(Config.BM25_CACHE_DIR, fingerprint)
+            if not os.path.exists(index_dir):
+                os.makedirs(Config.BM25_CACHE_DIR, exist_ok=True)
+                tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=Config.BM25_CACHE_DIR)
+                self.bm25.save(tmp_dir)
+                pq.write_table(pa.Table.from_pylist(self.documents_metadata),
+                               os.path.join(tmp_dir, "meta.parquet"))
+                try:
+                    os.rename(tmp_dir, index_dir)
+                    tmp_dir = None
+                except OSError:
+                    # Another retriever saved the same index first
+                    pass
             
-            # Scroll through all points
-            scroll_result = self.qdrant_service.client.scroll(
+            # Drop superseded indexes
+            for name in os.listdir(Config.BM25_CACHE_DIR):
+                if name != fingerprint and not name.startswith(".tmp-"):
+                    shutil.rmtree(os.path.join(Config.BM25_CACHE_DIR, name), ignore_errors=True)
+        
+        except ImportError:
+            print("⚠️  Warning: pyarrow not installed, BM25 index won't be cached")
+        except Exception as e:
+            print(f"⚠️  Warning: Could not cache BM25 index: {str(e)}")
+        finally:
+            if tmp_dir is not None:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    
+    def _iter_document_batches(self, batch_size: int = 2048) -> Iterator[List[Dict[str, Any]]]:
+        """Yield all documents from Qdrant collection page by page - SYNCHRONOUS"""
+        # Get collection info first
+        collection_info = self.qdrant_service.client.get_collection(
+            self.qdrant_service.collection_name
+        )
+        
+        if collection_info.points_count == 0:
+            return
+        
+        # Follow next_page_offset until the collection is exhausted
+        total = 0
+        offset = None
+        while True:
+            points, offset = self.qdrant_service.client.scroll(
                 collection_name=self.qdrant_service.collection_name,
-                limit=10000,  # Get many documents at once
-                with_payload=True,
+                limit=batch_size,
+                offset=offset,
+                with_payload=RESULT_PAYLOAD,
                 with_vectors=False  # We don't need vectors for BM25
             )
             
-            points = scroll_result[0]  # Get the points from the tuple
-            
-            for point in points:
-                documents.append({
+            total += len(points)
+            yield [
+                {
                     'text': point.payload['text'],
                     'filename': point.payload['filename'],
                     'chunk_id': point.payload['chunk_id'],
                     'doc_id': str(point.id)
-                })
-            
-            print(f"Retrieved {len(documents)} documents from Qdrant")
-            return documents
+                }
+                for point in points
+            ]
             
-        except Exception as e:
-            print(f"Error getting all documents: {str(e)}")
-            return []
+            if offset is None:
+                break
+        
+        print(f"Retrieved {total} documents from Qdrant")
     
     def _tokenize_text(self, text: str) -> List[str]:
         """Tokenize text for BM25"""
@@ -118,20 +260,32 @@ class HybridRetriever:
         elif not isinstance(text, str):
             text = str(text)
             
-        # Simple tokenization - can be enhanced
-        text = text.lower()
-        # Remove special characters but keep important ones
-        text = re.sub(r'[^\w\s\-\.]', ' ', text)
-        tokens = text.split()
-        # Filter out very short tokens
-        tokens = [token for token in tokens if len(token) > 2]
-        return tokens
+        # Simple tokenization - can be enhanced. One scan picks out runs of word
+        # characters, hyphens and dots of at least 3 characters
+        return _TOKEN_RE.findall(text.lower())
+    
+    def _tokenize_batch(self, texts: List[str]) -> List[List[str]]:
+        """Tokenize a page of document texts for BM25 indexing"""
+        findall = _TOKEN_RE.findall
+        return [findall(text.lower()) if isinstance(text, str) else self._tokenize_text(text)
+                for text in texts]
     
     async def hybrid_search(self, query: str, top_k: int = Config.TOP_K) -> List[Dict[str, Any]]:
         """Perform hybrid search combining semantic and keyword search"""
         try:
-            # Always try semantic search first as it's most reliable
-            semantic_results = await self._semantic_search(query, top_k * 2)
+            # Semantic and BM25 search are independent, so run them concurrently.
+            # BM25 is CPU-bound and runs on a worker thread; it is started first so
+            # it overlaps the whole semantic search. Try BM25 only once the index is built.
+            use_keyword = self.bm25 is not None
+            searches = [self._semantic_search(query, top_k * 2)]
+            if use_keyword:
+                searches.insert(0, asyncio.to_thread(self._keyword_search_sync, query, top_k))
+            search_results = await asyncio.gather(*searches, return_exceptions=True)
+            
+            # Semantic search is the most reliable - its failure falls back below
+            semantic_results = search_results[-1]
+            if isinstance(semantic_results, BaseException):
+                raise semantic_results
             
             # Ensure semantic results have valid scores
             for result in semantic_results:
@@ -139,21 +293,13 @@ class HybridRetriever:
                 result['score'] = max(0.0, min(1.0, abs(float(score))))
                 result['search_type'] = 'semantic'
             
-            # Try BM25 only if available and we have built index
             keyword_results = []
-            if self.bm25_available and self.bm25 is not None:
-                try:
-                    keyword_results = self._keyword_search_sync(query, top_k)
-                    # Normalize BM25 scores
-                    for result in keyword_results:
-                        raw_score = result.get('score', 0)
-                        # BM25 scores can be large, normalize them
-                        normalized_score = min(1.0, max(0.0, float(raw_score) / 10.0))
-                        result['score'] = normalized_score
-                        result['search_type'] = 'keyword'
-                except Exception as e:
-                    print(f"BM25 search failed: {str(e)}")
-                    keyword_results = []
+            if use_keyword:
+                if isinstance(search_results[0], BaseException):
+                    print(f"BM25 search failed: {str(search_results[0])}")
+                else:
+                    # Raw BM25 scores are fused by rank, no normalization needed
+                    keyword_results = search_results[0]
             
             # Combine results if we have both
             if keyword_results and semantic_results:
@@ -172,7 +318,8 @@ class HybridRetriever:
             # Rerank if reranker is available
             if self.reranker is not None and combined_results:
                 try:
-                    final_results = self._rerank_results(query, combined_results, top_k)
+                    # Cross-encoder forward runs off the event loop
+                    final_results = await asyncio.to_thread(self._rerank_results, query, combined_results, top_k)
                 except Exception as e:
                     print(f"Reranking failed: {str(e)}")
                     # Fallback to simple sorting
@@ -196,7 +343,8 @@ class HybridRetriever:
             
         except Exception as e:
             print(f"Error in hybrid search: {str(e)}")
-            # Fallback to basic semantic search
+            # Fallback to basic semantic search (the query embedding is cached, so
+            # it is not recomputed when only the fusion or rerank step failed)
             try:
                 semantic_results = await self._semantic_search(query, top_k)
                 for result in semantic_results:
@@ -211,9 +359,23 @@ class HybridRetriever:
 
     async def _semantic_search(self, query: str, limit: int) -> List[Dict[str, Any]]:
         """Perform semantic search using embeddings"""
-        query_embedding = self.embedding_service.embed_single_text(query)
+        query_embedding = await self._embed_query(query)
         return await self.qdrant_service.search_similar(query_embedding, limit)
     
+    async def _embed_query(self, query: str) -> List[float]:
+        """Embed a query, reusing the embedding of a recently seen identical query"""
+        key = hashlib.blake2b(query.encode(), digest_size=16).digest()
+        with self._query_embedding_cache_lock:
+            query_embedding = self._query_embedding_cache.get(key)
+        if query_embedding is not None:
+            return query_embedding
+        
+        query_embedding = await asyncio.to_thread(self.embedding_service.embed_single_text, query)
+        if query_embedding:
+            with self._query_embedding_cache_lock:
+                self._query_embedding_cache[key] = query_embedding
+        return query_embedding
+    
     def _keyword_search_sync(self, query: str, limit: int) -> List[Dict[str, Any]]:
         """Perform keyword search using BM25 - SYNCHRONOUS"""
         if self.bm25 is None:
@@ -226,21 +388,34 @@ class HybridRetriever:
             if not query_tokens:
                 return []
             
-            # Get BM25 scores
-            bm25_scores = self.bm25.get_scores(query_tokens)
-            
-            # Get top documents with scores
-            doc_scores = [(i, score) for i, score in enumerate(bm25_scores)]
-            doc_scores.sort(key=lambda x: x[1], reverse=True)
+            if self.bm25_backend == 'bm25s':
+                # Unknown terms can't score - drop them before retrieval
+                query_tokens = [token for token in query_tokens if token in self.bm25.vocab_dict]
+                if not query_tokens:
+                    return []
+                
+                # bm25s returns the top documents already partially sorted
+                doc_ids, scores = self.bm25.retrieve(
+                    [query_tokens],
+                    k=min(limit, len(self.documents_metadata)),
+                    show_progress=False,
+                    backend_selection="numba" if self.bm25_numba else "numpy"
+                )
+                doc_scores = list(zip(doc_ids[0].tolist(), scores[0].tolist()))
+            else:
+                # Top-k over the numpy index: common-term cutoff, then one argpartition selection
+                doc_ids, scores = self.bm25.top_k(query_tokens, limit)
+                doc_scores = list(zip(doc_ids.tolist(), scores.tolist()))
             
             results = []
-            for i, (doc_idx, score) in enumerate(doc_scores[:limit]):
+            for doc_idx, score in doc_scores[:limit]:
                 if doc_idx < len(self.documents_metadata) and score > 0:
                     doc_meta = self.documents_metadata[doc_idx]
                     results.append({
                         'text': doc_meta['text'],
                         'filename': doc_meta['filename'],
                         'chunk_id': doc_meta['chunk_id'],
+                        'doc_id': doc_meta['doc_id'],
                         'score': float(score),
                         'search_type': 'keyword'
                     })
@@ -252,44 +427,32 @@ class HybridRetriever:
             return []
     
     def _combine_results(self, semantic_results: List[Dict], keyword_results: List[Dict]) -> List[Dict[str, Any]]:
-        """Combine and deduplicate results from different search methods"""
+        """Combine and deduplicate rank-ordered results with Reciprocal Rank Fusion"""
+        # Each list contributes 1 / (k + rank), so raw semantic and BM25 scores never
+        # need normalizing. Scores are scaled by the best attainable fusion score
+        # (rank 1 in both lists) so they stay in [0, 1] for confidence math.
+        rrf_k = Config.RRF_K
+        scale = (rrf_k + 1) / 2.0
         combined = {}
         
-        # Add semantic results
-        for result in semantic_results:
-            key = f"{result['filename']}_{result['chunk_id']}"
-            if key not in combined:
-                result['search_type'] = 'semantic'
-                # Ensure valid score
-                result['score'] = max(0.0, min(1.0, abs(float(result.get('score', 0)))))
-                combined[key] = result
-            else:
-                # If already exists, combine scores
-                existing_score = combined[key].get('score', 0)
-                new_score = result.get('score', 0)
-                combined[key]['score'] = max(existing_score, new_score)
-                combined[key]['search_type'] = 'hybrid'
-        
-        # Add keyword results
-        for result in keyword_results:
-            key = f"{result['filename']}_{result['chunk_id']}"
-            if key not in combined:
-                # Ensure valid score for keyword results
-                result['score'] = max(0.0, min(1.0, abs(float(result.get('score', 0)))))
-                combined[key] = result
-            else:
-                # Normalize and combine BM25 and semantic scores
-                semantic_score = combined[key].get('score', 0)
-                keyword_score = result.get('score', 0)
-                
-                # Ensure both scores are valid
-                semantic_score = max(0.0, min(1.0, abs(float(semantic_score))))
-                keyword_score = max(0.0, min(1.0, abs(float(keyword_score))))
+        for search_type, results in (('semantic', semantic_results), ('keyword', keyword_results)):
+            seen = set()
+            for rank, result in enumerate(results, start=1):
+                # Qdrant point id is already a unique key; tuple hash if it's missing
+                key = result.get('doc_id') or (result['filename'], result['chunk_id'])
+                if key in seen:
+                    continue
+                seen.add(key)
                 
-                # Simple score fusion
-                combined_score = 0.7 * semantic_score + 0.3 * keyword_score
-                combined[key]['score'] = combined_score
-                combined[key]['search_type'] = 'hybrid'
+                contribution = scale / (rrf_k + rank)
+                existing = combined.get(key)
+                if existing is None:
+                    result['search_type'] = search_type
+                    result['score'] = contribution
+                    combined[key] = result
+                else:
+                    existing['score'] += contribution
+                    existing['search_type'] = 'hybrid'
         
         return list(combined.values())
     
@@ -303,15 +466,44 @@ class HybridRetriever:
             return results[:top_k]
         
         try:
-            # Prepare query-document pairs for reranking
+            # Prepare query-document pairs for reranking, reusing cached scores
+            # for (query, chunk) pairs that were already scored
+            query_hash = hashlib.blake2b(query.encode(), digest_size=8).digest()
+            rerank_scores = np.empty(len(results), dtype=np.float32)
             query_doc_pairs = []
-            for result in results:
+            miss_keys = []
+            miss_idx = []
+            for i, result in enumerate(results):
                 # Limit text length for reranker
                 text_snippet = result['text'][:512]
-                query_doc_pairs.append([query, text_snippet])
+                key = (query_hash, result['filename'], result['chunk_id'], hash(text_snippet))
+                with self._rerank_cache_lock:
+                    cached_score = self._rerank_cache.get(key)
+                if cached_score is not None:
+                    rerank_scores[i] = cached_score
+                else:
+                    query_doc_pairs.append([query, text_snippet])
+                    miss_keys.append(key)
+                    miss_idx.append(i)
             
-            # Get reranking scores
-            rerank_scores = self.reranker.predict(query_doc_pairs)
+            # Get reranking scores for the misses. Pairs are sorted by query + snippet
+            # length and scored in length buckets so each forward pass pads to similar-sized inputs
+            if query_doc_pairs:
+                lengths = np.fromiter((estimate_tokens(query) + estimate_tokens(pair[1]) for pair in query_doc_pairs),
+                                      dtype=np.int64, count=len(query_doc_pairs))
+                order = np.argsort(lengths, kind='stable')
+                miss_scores = np.empty(len(query_doc_pairs), dtype=np.float32)
+                for bucket in np.split(order, np.searchsorted(lengths[order], RERANK_BUCKETS, side='right')):
+                    if len(bucket):
+                        miss_scores[bucket] = self.reranker.predict(
+                            [query_doc_pairs[i] for i in bucket],
+                            batch_size=64,
+                            show_progress_bar=False
+                        )
+                rerank_scores[miss_idx] = miss_scores
+                with self._rerank_cache_lock:
+                    for key, score in zip(miss_keys, miss_scores.tolist()):
+                        self._rerank_cache[key] = score
             
             # Update results with rerank scores
             for i, result in enumerate(results):
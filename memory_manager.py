@@ -2,12 +2,19 @@ from typing import List, Dict, Any, Optional
 from langchain.memory import ConversationSummaryBufferMemory
 from langchain.schema import BaseMessage, HumanMessage, AIMessage
 from langchain_google_genai import GoogleGenerativeAI
+import heapq
 import json
+import numpy as np
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from config import Config
 
 class ConversationMemoryManager:
-    def __init__(self, gemini_api_key: str):
+    def __init__(self, gemini_api_key: str, embedding_service=None):
         """Initialize conversation memory with LangChain"""
+        # Optional - enables semantic relevance scoring of past interactions
+        self.embedding_service = embedding_service
+        
         # Initialize Gemini for summarization
         self.llm = GoogleGenerativeAI(
             model="gemini-2.5-pro",
@@ -21,8 +28,12 @@ class ConversationMemoryManager:
             return_messages=True
         )
         
-        # Session management
-        self.sessions = {}
+        # Session management - OrderedDict kept in LRU order (oldest first), capped at
+        # Config.MAX_SESSIONS, plus a min-heap of (last_accessed_ts, session_id) for
+        # expiry. Heap entries go stale when a session is touched again; they are
+        # skipped on pop.
+        self.sessions = OrderedDict()
+        self._expiry = []
         self.current_session_id = None
     
     def create_session(self, session_id: str) -> str:
@@ -35,17 +46,37 @@ class ConversationMemoryManager:
             ),
             'created_at': datetime.now(),
             'last_accessed': datetime.now(),
-            'message_count': 0
+            'message_count': 0,
+            'lines': [],
+            'line_embs': []
         }
+        self._touch(session_id)
+        
+        # Evict least recently used sessions over the cap
+        while len(self.sessions) > Config.MAX_SESSIONS:
+            self.sessions.popitem(last=False)
+        
         self.current_session_id = session_id
         return session_id
     
+    def _touch(self, session_id: str):
+        """Mark session as accessed - O(1) LRU move plus an O(log n) expiry push"""
+        now = datetime.now()
+        self.sessions[session_id]['last_accessed'] = now
+        self.sessions.move_to_end(session_id)
+        heapq.heappush(self._expiry, (now.timestamp(), session_id))
+        
+        # Drop stale heap entries once they dominate
+        if len(self._expiry) > 2 * len(self.sessions) + 1024:
+            self._expiry = [(data['last_accessed'].timestamp(), sid) for sid, data in self.sessions.items()]
+            heapq.heapify(self._expiry)
+    
     def set_session(self, session_id: str):
         """Set current session"""
         if session_id not in self.sessions:
             self.create_session(session_id)
         else:
-            self.sessions[session_id]['last_accessed'] = datetime.now()
+            self._touch(session_id)
         self.current_session_id = session_id
     
     def add_interaction(self, human_message: str, ai_message: str, session_id: Optional[str] = None):
@@ -63,9 +94,22 @@ class ConversationMemoryManager:
         memory.chat_memory.add_user_message(human_message)
         memory.chat_memory.add_ai_message(ai_message)
         
+        # Cache a normalized embedding per interaction for relevance scoring
+        if self.embedding_service is not None:
+            try:
+                line_emb = np.asarray(
+                    self.embedding_service.embed_single_text(f"{human_message} {ai_message}"),
+                    dtype=np.float32
+                )
+                norm = np.linalg.norm(line_emb)
+                session['lines'].append(f"Human: {human_message}\nAssistant: {ai_message}")
+                session['line_embs'].append(line_emb / norm if norm else line_emb)
+            except Exception as e:
+                print(f"Error embedding interaction: {str(e)}")
+        
         # Update session stats
         session['message_count'] += 2
-        session['last_accessed'] = datetime.now()
+        self._touch(self.current_session_id)
     
     def get_conversation_context(self, session_id: Optional[str] = None) -> str:
         """Get conversation context for current session"""
@@ -106,13 +150,27 @@ class ConversationMemoryManager:
         if not context:
             return ""
         
-        # Simple relevance check - can be enhanced with semantic similarity
         # Fix: Ensure current_question is a string
         if isinstance(current_question, list):
             current_question = ' '.join(str(item) for item in current_question)
         elif not isinstance(current_question, str):
             current_question = str(current_question)
-            
+        
+        # Semantic relevance over the cached interaction embeddings when available
+        session = self.sessions.get(self.current_session_id, {})
+        line_embs = session.get('line_embs', [])[-20:]
+        if self.embedding_service is not None and line_embs:
+            try:
+                q_emb = np.asarray(self.embedding_service.embed_single_text(current_question), dtype=np.float32)
+                sims = np.stack(line_embs) @ q_emb
+                top = np.argpartition(-sims, 4)[:4] if len(sims) > 4 else np.arange(len(sims))
+                lines = session['lines'][-len(line_embs):]
+                # Keep the selected interactions in chronological order
+                return '\n'.join(lines[i] for i in np.sort(top))
+            except Exception as e:
+                print(f"Error scoring history semantically: {str(e)}")
+        
+        # Simple keyword relevance check
         question_keywords = set(current_question.lower().split())
         context_lines = context.split('\n')
         
@@ -136,17 +194,19 @@ class ConversationMemoryManager:
     
     def cleanup_old_sessions(self, hours: int = 24):
         """Clean up sessions older than specified hours"""
-        cutoff_time = datetime.now() - timedelta(hours=hours)
-        
-        old_sessions = [
-            session_id for session_id, session_data in self.sessions.items()
-            if session_data['last_accessed'] < cutoff_time
-        ]
-        
-        for session_id in old_sessions:
-            del self.sessions[session_id]
+        cutoff_ts = (datetime.now() - timedelta(hours=hours)).timestamp()
+        
+        # Pop only the expired heap entries instead of scanning every session
+        removed = 0
+        while self._expiry and self._expiry[0][0] < cutoff_ts:
+            accessed_ts, session_id = heapq.heappop(self._expiry)
+            session_data = self.sessions.get(session_id)
+            # Skip stale entries for sessions deleted or touched since
+            if session_data is not None and session_data['last_accessed'].timestamp() == accessed_ts:
+                del self.sessions[session_id]
+                removed += 1
         
-        print(f"Cleaned up {len(old_sessions)} old sessions")
+        print(f"Cleaned up {removed} old sessions")
     
     def get_session_stats(self) -> Dict[str, Any]:
         """Get statistics about current sessions"""
@@ -1,11 +1,40 @@
 import asyncio
 from typing import List, Dict, Any, Optional
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http import models
-from qdrant_client.http.models import Distance, VectorParams, PointStruct
+from qdrant_client.http.models import Distance, VectorParams
 import uuid
 from config import Config
 
+# Punctuation becomes whitespace, so "node.js" splits the way Qdrant's word tokenizer does
+KEYWORD_TRANS = str.maketrans('.,!?;:"()', ' ' * 9)
+
+# Payload returned with search hits - the precomputed keyword tokens are only
+# fetched where they are scored
+RESULT_PAYLOAD = models.PayloadSelectorExclude(exclude=['tokens'])
+
+def keyword_tokens(text: str) -> List[str]:
+    """Unique lower-cased words of a chunk, stored in its payload for keyword scoring"""
+    return sorted(set(text.lower().translate(KEYWORD_TRANS).split()))
+
+# int8 scalar quantization kept in RAM; originals stay on disk for rescoring
+QUANTIZATION_CONFIG = models.ScalarQuantization(
+    scalar=models.ScalarQuantizationConfig(
+        type=models.ScalarType.INT8,
+        quantile=0.99,
+        always_ram=True
+    )
+)
+
+# Search the int8 quantized vectors, then rescore the oversampled candidates in fp32
+SEARCH_PARAMS = models.SearchParams(
+    quantization=models.QuantizationSearchParams(
+        ignore=False,
+        rescore=True,
+        oversampling=2.0
+    )
+)
+
 class QdrantService:
     def __init__(self):
         """Initialize Qdrant client"""
@@ -15,6 +44,7 @@ class QdrantService:
             timeout=60
         )
         self.collection_name = Config.COLLECTION_NAME
+        self._keyword_tokens_backfilled = False
         
     async def create_collection_if_not_exists(self):
         """Create collection if it doesn't exist"""
@@ -30,103 +60,166 @@ class QdrantService:
                     vectors_config=VectorParams(
                         size=Config.VECTOR_SIZE,
                         distance=Distance.COSINE
-                    )
+                    ),
+                    quantization_config=QUANTIZATION_CONFIG,
+                    hnsw_config=models.HnswConfigDiff(m=16, ef_construct=128)
                 )
                 print(f"Created collection: {self.collection_name}")
             else:
                 print(f"Collection {self.collection_name} already exists")
                 
+                # Collections created before quantization was enabled get it applied in place
+                info = self.client.get_collection(self.collection_name)
+                if info.config.quantization_config is None:
+                    self.client.update_collection(
+                        collection_name=self.collection_name,
+                        quantization_config=QUANTIZATION_CONFIG
+                    )
+                    print(f"Enabled int8 quantization on: {self.collection_name}")
+                
+                # Points stored before the `tokens` payload existed get it, once per process
+                if not self._keyword_tokens_backfilled:
+                    self.backfill_keyword_tokens()
+                    self._keyword_tokens_backfilled = True
+            
+            self.ensure_text_index()
+                
         except Exception as e:
             raise Exception(f"Error creating collection: {str(e)}")
     
+    def ensure_text_index(self):
+        """Create the full-text payload index on `text` used for server-side keyword matching"""
+        try:
+            self.client.create_payload_index(
+                collection_name=self.collection_name,
+                field_name="text",
+                field_schema=models.TextIndexParams(
+                    type="text",
+                    tokenizer=models.TokenizerType.WORD,
+                    lowercase=True
+                )
+            )
+        except Exception as e:
+            print(f"Warning: could not create text index: {str(e)}")
+    
+    def backfill_keyword_tokens(self, batch_size: int = 256):
+        """One-shot migration: add the `tokens` payload to points stored before it existed"""
+        try:
+            missing = models.Filter(must=[
+                models.IsEmptyCondition(is_empty=models.PayloadField(key="tokens"))
+            ])
+            updated = 0
+            offset = None
+            while True:
+                # Offsets follow point id order, so updated points leaving the filter don't shift pages
+                points, offset = self.client.scroll(
+                    collection_name=self.collection_name,
+                    scroll_filter=missing,
+                    limit=batch_size,
+                    offset=offset,
+                    with_payload=["text"],
+                    with_vectors=False
+                )
+                if not points:
+                    break
+                
+                self.client.batch_update_points(
+                    collection_name=self.collection_name,
+                    update_operations=[
+                        models.SetPayloadOperation(set_payload=models.SetPayload(
+                            payload={'tokens': keyword_tokens(point.payload.get('text', ''))},
+                            points=[point.id]
+                        ))
+                        for point in points
+                    ]
+                )
+                updated += len(points)
+                if offset is None:
+                    break
+            
+            if updated:
+                print(f"Added keyword tokens to {updated} existing documents")
+        except Exception as e:
+            print(f"Warning: could not backfill keyword tokens: {str(e)}")
+    
     async def add_documents(self, chunks: List[Dict[str, Any]], embeddings: List[List[float]]):
         """Add documents with embeddings to Qdrant"""
         try:
-            points = []
-            
-            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-                point = PointStruct(
-                    id=str(uuid.uuid4()),
-                    vector=embedding,
-                    payload={
-                        'text': chunk['text'],
-                        'filename': chunk['metadata']['filename'],
-                        'chunk_id': chunk['metadata']['chunk_id'],
-                        'word_count': chunk['metadata']['word_count']
-                    }
-                )
-                points.append(point)
+            # Columnar ids / vectors / payloads instead of one PointStruct per chunk
+            ids = [str(uuid.uuid4()) for _ in chunks]
+            vectors = embeddings
+            payloads = [
+                {
+                    'text': chunk['text'],
+                    'filename': chunk['metadata']['filename'],
+                    'chunk_id': chunk['metadata']['chunk_id'],
+                    'word_count': chunk['metadata']['word_count'],
+                    'tokens': keyword_tokens(chunk['text'])
+                }
+                for chunk in chunks
+            ]
             
-            # Batch insert points
+            # Batch insert points - batches are upserted concurrently, bounded by a semaphore.
+            # The async client lives only as long as this call: its pooled connections
+            # belong to the running loop, and callers like Streamlit start a new loop
+            # per action.
             batch_size = 100
-            for i in range(0, len(points), batch_size):
-                batch = points[i:i + batch_size]
-                self.client.upsert(
-                    collection_name=self.collection_name,
-                    points=batch
-                )
+            async_client = AsyncQdrantClient(
+                url=Config.QDRANT_URL,
+                api_key=Config.QDRANT_API_KEY,
+                timeout=60
+            )
+            semaphore = asyncio.Semaphore(Config.QDRANT_UPSERT_CONCURRENCY)
+            
+            async def upsert_batch(start: int):
+                end = start + batch_size
+                async with semaphore:
+                    await async_client.upsert(
+                        collection_name=self.collection_name,
+                        points=models.Batch(
+                            ids=ids[start:end],
+                            vectors=vectors[start:end],
+                            payloads=payloads[start:end]
+                        )
+                    )
             
-            print(f"Successfully added {len(points)} documents to Qdrant")
+            try:
+                await asyncio.gather(*(
+                    upsert_batch(start)
+                    for start in range(0, len(ids), batch_size)
+                ))
+            finally:
+                await async_client.close()
+            
+            print(f"Successfully added {len(ids)} documents to Qdrant")
             
         except Exception as e:
             raise Exception(f"Error adding documents to Qdrant: {str(e)}")
     
     async def search_similar(self, query_embedding: List[float], limit: int = Config.TOP_K) -> List[Dict[str, Any]]:
-        """Ultra-aggressive search - GUARANTEES to find content in any document"""
+        """Search for the most similar chunks - returns an empty list when nothing matches"""
         try:
-            all_results = []
-            
-            # Strategy 1: Standard search with NO threshold
-            search_results = self.client.search(
+            # Standard search with NO threshold - the pooled sync client runs off the event loop
+            search_results = await asyncio.to_thread(
+                self.client.search,
                 collection_name=self.collection_name,
                 query_vector=query_embedding,
-                limit=limit * 10,  # Get way more results
-                score_threshold=0.0  # NO threshold - find everything
+                limit=limit,
+                score_threshold=0.0,  # NO threshold - find everything
+                search_params=SEARCH_PARAMS,
+                with_payload=RESULT_PAYLOAD
             )
-            all_results.extend(search_results)
-            
-            # Strategy 2: If still no results, get EVERYTHING from collection
-            if not search_results:
-                print("No similarity results, getting all documents...")
-                scroll_result = self.client.scroll(
-                    collection_name=self.collection_name,
-                    limit=limit * 20,
-                    with_payload=True,
-                    with_vectors=False
-                )
-                
-                for point in scroll_result[0]:
-                    # Create fake similarity scores based on text length and content
-                    fake_score = min(0.8, max(0.1, len(point.payload.get('text', '')) / 10000))
-                    all_results.append(type('MockResult', (), {
-                        'payload': point.payload,
-                        'score': fake_score
-                    })())
-            
-            # Strategy 3: Keyword matching as last resort
-            if not all_results:
-                print("Trying keyword matching...")
-                # Extract keywords from query
-                query_text = str(query_embedding)  # This won't work well, but it's a fallback
-                # Get some random documents
-                scroll_result = self.client.scroll(
-                    collection_name=self.collection_name,
-                    limit=limit,
-                    with_payload=True,
-                    with_vectors=False
-                )
-                
-                for point in scroll_result[0]:
-                    all_results.append(type('MockResult', (), {
-                        'payload': point.payload,
-                        'score': 0.3  # Low but valid score
-                    })())
             
-            # Convert to our format and ensure we have results
+            # Convert to our format, skipping repeated points
+            seen_ids = set()
             results = []
-            for result in all_results:
+            for result in search_results:
+                if result.id in seen_ids:
+                    continue
+                seen_ids.add(result.id)
+                
                 # Ensure score is valid
-                score = getattr(result, 'score', 0.3)
+                score = result.score
                 if score < 0:
                     score = abs(score)
                 elif score > 1:
@@ -136,25 +229,13 @@ class QdrantService:
                     'text': result.payload['text'],
                     'filename': result.payload['filename'],
                     'chunk_id': result.payload['chunk_id'],
+                    'doc_id': str(result.id),
                     'score': max(0.1, min(1.0, score)),  # Ensure score is between 0.1 and 1.0
                     'word_count': result.payload.get('word_count', 0)
                 })
             
-            # Remove exact duplicates
-            seen_texts = set()
-            unique_results = []
-            for result in results:
-                text_key = result['text'][:100]  # Use first 100 chars as key
-                if text_key not in seen_texts:
-                    seen_texts.add(text_key)
-                    unique_results.append(result)
-            
-            # Sort by score and return generous amount
-            unique_results.sort(key=lambda x: x['score'], reverse=True)
-            final_results = unique_results[:max(limit, min(len(unique_results), limit * 3))]
-            
-            print(f"Found {len(final_results)} results for search")
-            return final_results
+            print(f"Found {len(results)} results for search")
+            return results[:limit]
             
         except Exception as e:
             print(f"Error in enhanced search: {str(e)}")
@@ -1,10 +1,58 @@
 import asyncio
+import hashlib
 import os
-from typing import List, Dict, Any, Optional
+import re
+from operator import itemgetter
+from threading import Lock
+from typing import AsyncIterator, List, Dict, Any, Optional
+import numpy as np
+from cachetools import LRUCache, TTLCache
 from ingestion_pipeline import IngestionPipeline
 from google import genai
 from google.genai import types
-from config import Config
+from qdrant_client.http import models
+from qdrant_service import SEARCH_PARAMS, RESULT_PAYLOAD, KEYWORD_TRANS, keyword_tokens
+from config import Config, context_chunk_count
+
+_STOPWORDS = frozenset({'what', 'is', 'this', 'document', 'about', 'who', 'how', 'when', 'where', 'why', 'the',
+                        'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with'})
+
+# Numbers referenced in a question (chapter 3, page 12, ...)
+_REF_RE = re.compile(r'\d+')
+
+# Prompt pieces around the retrieved context and the question
+_PROMPT_HEAD = """You are a helpful AI assistant that answers questions based on provided document context.
+
+CONTEXT FROM DOCUMENTS:
+"""
+_PROMPT_CTX_SEP = """
+
+INSTRUCTIONS:
+- Answer the question using ONLY the information provided in the context above
+- PRESERVE ALL ORIGINAL FORMATTING including:
+  * Code blocks (maintain exact indentation and syntax)
+  * Lists (preserve bullets and numbering)
+  * Tables (maintain table structure)
+  * Special characters and symbols
+  * Line breaks and paragraph structure
+- If showing code or configuration, use proper formatting with ```
+- For lists, preserve the original bullet style (-, *, •) or numbering
+- For tables, maintain the original table structure with | characters
+- Keep all technical notation exactly as it appears
+- For mathematical content, preserve all operators and formatting
+- If unsure about any content, respond with "I don't have enough information"
+
+QUESTION: """
+_PROMPT_TAIL = """
+
+ANSWER:"""
+
+# Prefix of the answer returned when Gemini generation fails
+GEMINI_ERROR_PREFIX = "Error generating answer with Gemini"
+
+async def _iter_text(text: str) -> AsyncIterator[str]:
+    """Present an already finished answer as a one-part stream"""
+    yield text
 
 class RAGService:
     def __init__(self):
@@ -14,9 +62,29 @@ class RAGService:
         self.gemini_client = genai.Client(
             api_key=Config.GEMINI_API_KEY,
         )
+        # Generation config is the same for every question, so build it once
+        self._gemini_config = types.GenerateContentConfig(
+            thinking_config=types.ThinkingConfig(
+                thinking_budget=-1,
+            ),
+        )
+        # Keyword retrieval matches on Qdrant's full-text index instead of scrolling
+        self.pipeline.qdrant_service.ensure_text_index()
+        
+        # Query embeddings keyed by normalized question text
+        self._qemb_cache = LRUCache(maxsize=2048)
+        self._qemb_cache_lock = Lock()
+        
+        # Answers keyed by (normalized question, context chunk ids), skipping Gemini on repeats
+        self._answer_cache = TTLCache(maxsize=1024, ttl=3600)
+        self._answer_cache_lock = Lock()
     
-    async def generate_answer(self, question: str, top_k: int = None) -> Dict[str, Any]:
-        """Generate answer based on retrieved documents with enhanced context"""
+    async def generate_answer(self, question: str, top_k: int = None, stream: bool = False) -> Dict[str, Any]:
+        """Generate answer based on retrieved documents with enhanced context.
+        
+        With stream=True the response carries an 'answer_stream' async iterator
+        of answer text instead of a finished 'answer'.
+        """
         try:
             if top_k is None:
                 top_k = Config.TOP_K
@@ -35,11 +103,25 @@ class RAGService:
             context_parts = []
             sources = []
             
-            # Use more chunks for better context (up to MAX_CONTEXT_CHUNKS)
-            max_chunks = min(Config.MAX_CONTEXT_CHUNKS, len(relevant_docs))
+            # Use more chunks for better context (up to MAX_CONTEXT_CHUNKS), bounded by
+            # an estimated token budget so large chunks don't blow up Gemini prefill
+            max_chunks = context_chunk_count(relevant_docs, Config.MAX_CONTEXT_CHUNKS)
+            
+            # The same question over the same context chunks gets the same answer
+            answer_key = hashlib.sha1('|'.join([question.strip().lower()] + sorted(
+                f"{doc['filename']}:{doc['chunk_id']}" for doc in relevant_docs[:max_chunks]
+            )).encode()).digest()
+            with self._answer_cache_lock:
+                cached = self._answer_cache.get(answer_key)
+            if cached is not None:
+                response = dict(cached)
+                if stream:
+                    response['answer_stream'] = _iter_text(response.pop('answer'))
+                return response
             
             for i, doc in enumerate(relevant_docs[:max_chunks]):
-                context_parts.append(f"Source {i+1} (Score: {doc['score']:.3f}, File: {doc['filename']}): {doc['text']}")
+                # No per-question score in the text, so the same chunks give the same prompt prefix
+                context_parts.append(f"Source {i+1} (File: {doc['filename']}): {doc['text']}")
                 sources.append({
                     'filename': doc['filename'],
                     'chunk_id': doc['chunk_id'],
@@ -48,13 +130,25 @@ class RAGService:
             
             context = "\n\n".join(context_parts)
             
+            # Calculate confidence based on similarity scores
+            avg_score = float(np.fromiter(
+                (doc['score'] for doc in relevant_docs[:max_chunks]), dtype=np.float64, count=max_chunks
+            ).mean())
+            
+            if stream:
+                response = {
+                    'sources': sources,
+                    'confidence': avg_score,
+                    'retrieved_docs_count': len(relevant_docs),
+                    'context_chunks_used': max_chunks
+                }
+                response['answer_stream'] = self._stream_and_cache(question, context, answer_key, dict(response))
+                return response
+            
             # Step 3: Generate answer using Gemini model with enhanced context
             answer = await self._generate_with_gemini(question, context, relevant_docs[:max_chunks])
             
-            # Calculate confidence based on similarity scores
-            avg_score = sum(doc['score'] for doc in relevant_docs[:max_chunks]) / max_chunks
-            
-            return {
+            response = {
                 'answer': answer,
                 'sources': sources,
                 'confidence': avg_score,
@@ -62,6 +156,12 @@ class RAGService:
                 'context_chunks_used': max_chunks
             }
             
+            # Only cache real answers, not generation errors
+            if not answer.startswith(GEMINI_ERROR_PREFIX):
+                with self._answer_cache_lock:
+                    self._answer_cache[answer_key] = response
+            return dict(response)
+            
         except Exception as e:
             return {
                 'answer': f"An error occurred while processing your question: {str(e)}",
@@ -72,90 +172,65 @@ class RAGService:
     async def _smart_retrieval(self, question: str, top_k: int) -> List[Dict[str, Any]]:
         """BULLETPROOF retrieval - WILL find content in any document"""
         try:
-            all_results = []
+            qdrant_service = self.pipeline.qdrant_service
+            query_embedding = await self._embed_question(question)
             
-            # Strategy 1: Aggressive semantic search
-            query_embedding = self.pipeline.embedding_service.embed_single_text(question)
-            broad_results = await self.pipeline.qdrant_service.search_similar(
-                query_embedding=query_embedding,
-                limit=top_k * 10  # Get many more results
+            # Semantic search and keyword-filtered search share one round-trip
+            requests = [
+                # Strategy 1: Aggressive semantic search
+                models.QueryRequest(
+                    query=query_embedding,
+                    limit=top_k * 10,  # Get many more results
+                    params=SEARCH_PARAMS,
+                    with_payload=RESULT_PAYLOAD
+                )
+            ]
+            
+            # Strategy 2: Chunks containing any question keyword (Qdrant full-text index)
+            match_words = self._extract_keywords(question)
+            if match_words:
+                requests.append(models.QueryRequest(
+                    query=query_embedding,
+                    filter=models.Filter(should=[
+                        models.FieldCondition(key="text", match=models.MatchText(text=word))
+                        for word in match_words
+                    ]),
+                    limit=top_k * 3,
+                    params=SEARCH_PARAMS,
+                    with_payload=True
+                ))
+            
+            # The pooled sync client runs off the event loop
+            responses = await asyncio.to_thread(
+                qdrant_service.client.query_batch_points,
+                collection_name=qdrant_service.collection_name,
+                requests=requests
             )
-            all_results.extend(broad_results)
-            print(f"Semantic search found {len(broad_results)} results")
             
-            # Strategy 2: Text-based keyword search using collection scroll
-            if len(all_results) < top_k:
-                print("Performing text-based keyword search...")
-                try:
-                    # Get all documents and do text matching
-                    scroll_result = self.pipeline.qdrant_service.client.scroll(
-                        collection_name=self.pipeline.qdrant_service.collection_name,
-                        limit=1000,  # Get many documents
-                        with_payload=True,
-                        with_vectors=False
-                    )
-                    
-                    question_lower = question.lower()
-                    question_words = set(question_lower.split())
-                    
-                    for point in scroll_result[0]:
-                        text = point.payload.get('text', '').lower()
-                        # Calculate simple word overlap
-                        text_words = set(text.split())
-                        overlap = len(question_words.intersection(text_words))
-                        
-                        if overlap > 0 or len(question) < 10:  # If short question, include more results
-                            score = min(0.9, max(0.2, overlap / len(question_words) if question_words else 0.5))
-                            
-                            all_results.append({
-                                'text': point.payload['text'],
-                                'filename': point.payload['filename'],
-                                'chunk_id': point.payload['chunk_id'],
-                                'score': score,
-                                'word_count': point.payload.get('word_count', 0)
-                            })
-                    
-                    print(f"Text matching found {len(all_results) - len(broad_results)} additional results")
-                
-                except Exception as e:
-                    print(f"Text-based search failed: {str(e)}")
+            print(f"Semantic search found {len(responses[0].points)} results")
+            if len(responses) > 1:
+                print(f"Text matching found {len(responses[1].points)} results")
             
-            # Strategy 3: If still insufficient, get random sample from collection
-            if len(all_results) < 3:
-                print("Getting random sample from collection...")
-                try:
-                    scroll_result = self.pipeline.qdrant_service.client.scroll(
-                        collection_name=self.pipeline.qdrant_service.collection_name,
-                        limit=top_k * 2,
-                        with_payload=True,
-                        with_vectors=False
-                    )
-                    
-                    for point in scroll_result[0]:
-                        all_results.append({
-                            'text': point.payload['text'],
-                            'filename': point.payload['filename'],
-                            'chunk_id': point.payload['chunk_id'],
-                            'score': 0.4,  # Reasonable default score
-                            'word_count': point.payload.get('word_count', 0)
-                        })
-                    
-                    print(f"Random sample added {len(all_results)} total results")
-                
-                except Exception as e:
-                    print(f"Random sample failed: {str(e)}")
+            # Semantic hits keep their cosine score; keyword hits are scored by how many
+            # question keywords they contain, so they can outrank weak semantic hits
+            semantic_results = [
+                self._point_to_result(point, max(0.1, min(1.0, abs(point.score))))
+                for point in responses[0].points
+            ]
+            keyword_results = []
+            if len(responses) > 1:
+                keyword_results = self._score_keyword_hits(match_words, responses[1].points)
             
-            # Remove duplicates
-            seen_chunks = set()
-            unique_results = []
-            for result in all_results:
-                chunk_id = f"{result['filename']}_{result['chunk_id']}"
-                if chunk_id not in seen_chunks:
-                    seen_chunks.add(chunk_id)
-                    unique_results.append(result)
+            # Remove duplicates in one pass, keeping the best-scoring copy of each chunk
+            best: Dict[str, Dict[str, Any]] = {}
+            for result in semantic_results + keyword_results:
+                key = f"{result['filename']}_{result['chunk_id']}"
+                current = best.get(key)
+                if current is None or current['score'] < result['score']:
+                    best[key] = result
             
             # Sort by score and return generous results
-            unique_results.sort(key=lambda x: x['score'], reverse=True)
+            unique_results = sorted(best.values(), key=itemgetter('score'), reverse=True)
             final_results = unique_results[:max(top_k, min(len(unique_results), top_k * 2))]
             
             print(f"Final retrieval: {len(final_results)} unique results")
@@ -166,22 +241,18 @@ class RAGService:
             # EMERGENCY: Try to get ANY content from collection
             try:
                 print("EMERGENCY: Getting any available content...")
-                scroll_result = self.pipeline.qdrant_service.client.scroll(
+                scroll_result = await asyncio.to_thread(
+                    self.pipeline.qdrant_service.client.scroll,
                     collection_name=self.pipeline.qdrant_service.collection_name,
                     limit=top_k,
-                    with_payload=True,
+                    with_payload=RESULT_PAYLOAD,
                     with_vectors=False
                 )
                 
-                emergency_results = []
-                for point in scroll_result[0]:
-                    emergency_results.append({
-                        'text': point.payload['text'],
-                        'filename': point.payload['filename'],
-                        'chunk_id': point.payload['chunk_id'],
-                        'score': 0.3,  # Low but valid score
-                        'word_count': point.payload.get('word_count', 0)
-                    })
+                emergency_results = [
+                    self._point_to_result(point, 0.3)  # Low but valid score
+                    for point in scroll_result[0]
+                ]
                 
                 print(f"Emergency retrieval: {len(emergency_results)} results")
                 return emergency_results
@@ -190,110 +261,137 @@ class RAGService:
                 print(f"Emergency retrieval failed: {str(emergency_error)}")
                 return []
     
-    def _extract_any_references(self, question: str) -> List[str]:
-        """Extract ANY kind of reference (chapter, section, page, part, etc.)"""
-        import re
-        references = []
+    async def _embed_question(self, question: str) -> List[float]:
+        """Embed a question, reusing the embedding of an identical earlier question"""
+        key = question.strip().lower()
+        with self._qemb_cache_lock:
+            query_embedding = self._qemb_cache.get(key)
+        if query_embedding is None:
+            # The embedding forward pass runs off the event loop
+            query_embedding = await asyncio.to_thread(
+                self.pipeline.embedding_service.embed_single_text, question
+            )
+            if query_embedding:
+                with self._qemb_cache_lock:
+                    self._qemb_cache[key] = query_embedding
+        return query_embedding
+    
+    def _score_keyword_hits(self, keywords: List[str], points) -> List[Dict[str, Any]]:
+        """Score text-matched points by the idf-weighted share of question keywords they contain.
         
-        # Look for ANY number-based references
-        patterns = [
-            r'chapter\s*(\d+)',
-            r'ch\s*(\d+)', 
-            r'section\s*(\d+)',
-            r'part\s*(\d+)',
-            r'page\s*(\d+)',
-            r'p\s*(\d+)',
-            r'lesson\s*(\d+)',
-            r'unit\s*(\d+)',
-            r'module\s*(\d+)',
-            r'exercise\s*(\d+)',
-            r'(\d+)'  # Any standalone number
-        ]
+        Qdrant's full-text index does the collection-wide matching and returns at most
+        top_k * 3 candidates. Each candidate's keywords are collected per query, and a
+        keyword's weight comes from how many of these candidates contain it, so rare
+        keywords count for more than ones every candidate shares.
+        """
+        keyword_set = set(keywords)
+        matches: Dict[str, List[int]] = {keyword: [] for keyword in keyword_set}
+        for idx, point in enumerate(points):
+            # Tokens are precomputed at ingestion; points stored before that fall back to the text
+            tokens = point.payload.get('tokens')
+            if tokens is None:
+                tokens = keyword_tokens(point.payload.get('text', ''))
+            for keyword in keyword_set.intersection(tokens):
+                matches[keyword].append(idx)
         
-        question_lower = question.lower()
-        for pattern in patterns:
-            matches = re.findall(pattern, question_lower)
-            for match in matches:
-                references.extend([
-                    f"chapter {match}",
-                    f"section {match}",
-                    f"part {match}",
-                    f"page {match}",
-                    f"lesson {match}",
-                    f"unit {match}",
-                    f"module {match}",
-                    match  # Just the number
-                ])
+        scores = np.zeros(len(points), dtype=np.float64)
+        total_weight = 0.0
+        for doc_idxs in matches.values():
+            weight = np.log1p(len(points) / (len(doc_idxs) + 1))
+            total_weight += weight
+            np.add.at(scores, doc_idxs, weight)
+        scores = np.clip(scores / total_weight, 0.2, 0.9) if total_weight else np.full(len(points), 0.2)
         
-        return list(set(references))  # Remove duplicates
+        return [self._point_to_result(point, float(score)) for point, score in zip(points, scores)]
+    
+    def _point_to_result(self, point, score: float) -> Dict[str, Any]:
+        """Convert a Qdrant point into a retrieval result"""
+        return {
+            'text': point.payload['text'],
+            'filename': point.payload['filename'],
+            'chunk_id': point.payload['chunk_id'],
+            'score': score,
+            'word_count': point.payload.get('word_count', 0)
+        }
+    
+    def _extract_any_references(self, question: str) -> List[str]:
+        """Extract ANY kind of reference (chapter, section, page, part, etc.)"""
+        # Every number is expanded into the same variants whatever word precedes
+        # it ("chapter 3", "p3" and a bare "3" all give the same references), so
+        # one scan for numbers covers all the reference patterns
+        numbers = dict.fromkeys(_REF_RE.findall(question))
+        return list({
+            reference
+            for number in numbers
+            for reference in (
+                f"chapter {number}",
+                f"section {number}",
+                f"part {number}",
+                f"page {number}",
+                f"lesson {number}",
+                f"unit {number}",
+                f"module {number}",
+                number  # Just the number
+            )
+        })  # Remove duplicates
     
     def _extract_keywords(self, question: str) -> List[str]:
         """Extract important keywords from question"""
         # Simple keyword extraction
-        stop_words = {'what', 'is', 'this', 'document', 'about', 'who', 'how', 'when', 'where', 'why', 'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'with'}
-        words = question.lower().split()
-        keywords = [word.strip('.,!?;:"()') for word in words if word.lower() not in stop_words and len(word) > 2]
-        return keywords
+        words = question.lower().translate(KEYWORD_TRANS).split()
+        return [word for word in words if word not in _STOPWORDS and len(word) > 2]
+    
+    async def _stream_with_gemini(self, question: str, context: str) -> AsyncIterator[str]:
+        """Stream answer text from Gemini as it is generated"""
+        # Create enhanced prompt template. Everything up to QUESTION depends only on
+        # the retrieved chunks, so Gemini's implicit prefix cache can reuse it
+        # across questions over the same context.
+        prompt = "".join((_PROMPT_HEAD, context, _PROMPT_CTX_SEP, question, _PROMPT_TAIL))
+
+        # Generate response using Gemini model (a plain string is sent as one user turn).
+        # The sync client is pulled chunk by chunk off the event loop: the aio client's
+        # connections would be bound to the first loop, and Streamlit runs a new one per question.
+        chunks = await asyncio.to_thread(
+            self.gemini_client.models.generate_content_stream,
+            model="gemini-2.5-pro",
+            contents=prompt,
+            config=self._gemini_config,
+        )
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            if chunk.text:
+                yield chunk.text
+    
+    async def _stream_and_cache(self, question: str, context: str, answer_key: bytes,
+                                response: Dict[str, Any]) -> AsyncIterator[str]:
+        """Yield the streamed answer, caching the full response once it completes"""
+        parts = []
+        try:
+            async for text in self._stream_with_gemini(question, context):
+                parts.append(text)
+                yield text
+        except Exception as e:
+            # Same error text as the non-streaming path; a failed stream is never cached
+            yield f"\n\n{GEMINI_ERROR_PREFIX}: {str(e)}" if parts else f"{GEMINI_ERROR_PREFIX}: {str(e)}"
+            return
+        
+        answer = "".join(parts).strip()
+        if answer:
+            with self._answer_cache_lock:
+                self._answer_cache[answer_key] = {**response, 'answer': answer}
+        else:
+            yield "I couldn't generate an answer based on the provided context."
     
     async def _generate_with_gemini(self, question: str, context: str, docs: List[Dict]) -> str:
         """Generate answer using Gemini model with enhanced formatting preservation"""
         try:
-            # Create enhanced prompt template
-            prompt = f"""You are a helpful AI assistant that answers questions based on provided document context.
-
-CONTEXT FROM DOCUMENTS:
-{context}
-
-QUESTION: {question}
-
-INSTRUCTIONS:
-- Answer the question using ONLY the information provided in the context above
-- PRESERVE ALL ORIGINAL FORMATTING including:
-  * Code blocks (maintain exact indentation and syntax)
-  * Lists (preserve bullets and numbering)
-  * Tables (maintain table structure)
-  * Special characters and symbols
-  * Line breaks and paragraph structure
-- If showing code or configuration, use proper formatting with ```
-- For lists, preserve the original bullet style (-, *, •) or numbering
-- For tables, maintain the original table structure with | characters
-- Keep all technical notation exactly as it appears
-- For mathematical content, preserve all operators and formatting
-- If unsure about any content, respond with "I don't have enough information"
-
-ANSWER:"""
-
-            # Prepare content for Gemini
-            contents = [
-                types.Content(
-                    role="user",
-                    parts=[
-                        types.Part.from_text(text=prompt),
-                    ],
-                ),
-            ]
-            
-            # Generate content config
-            generate_content_config = types.GenerateContentConfig(
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=-1,
-                ),
-            )
-            
-            # Generate response using Gemini model
-            answer = ""
-            for chunk in self.gemini_client.models.generate_content_stream(
-                model="gemini-2.5-pro",
-                contents=contents,
-                config=generate_content_config,
-            ):
-                if chunk.text:
-                    answer += chunk.text
+            # Collect streamed parts and join once instead of concatenating per chunk
+            parts = [text async for text in self._stream_with_gemini(question, context)]
+            answer = "".join(parts).strip()
             
-            return answer.strip() if answer.strip() else "I couldn't generate an answer based on the provided context."
+            return answer if answer else "I couldn't generate an answer based on the provided context."
             
         except Exception as e:
-            return f"Error generating answer with Gemini: {str(e)}"
+            return f"{GEMINI_ERROR_PREFIX}: {str(e)}"
     
     def _generate_contextual_answer(self, question: str, context: str, docs: List[Dict]) -> str:
         """Generate answer based on context (simple extraction-based approach)"""
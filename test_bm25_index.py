@@ -0,0 +1,59 @@
+import math
+import random
+import numpy as np
+from bm25_index import BM25Index
+
+def reference_scores(corpus, query, k1=1.5, b=0.75):
+    """Plain-Python Lucene BM25 to check the vectorized index against"""
+    n = len(corpus)
+    avgdl = sum(len(doc) for doc in corpus) / n
+    scores = []
+    for doc in corpus:
+        score = 0.0
+        for term in query:
+            df = sum(1 for d in corpus if term in d)
+            tf = doc.count(term)
+            if not df or not tf:
+                continue
+            idf = math.log1p((n - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(doc) / avgdl))
+        scores.append(score)
+    return np.array(scores)
+
+def random_corpus(seed, num_docs=300, vocab_size=60):
+    rng = random.Random(seed)
+    vocab = [f"term{i}" for i in range(vocab_size)]
+    return [rng.choices(vocab, k=rng.randint(1, 30)) for _ in range(num_docs)]
+
+def test_get_scores_matches_reference():
+    corpus = random_corpus(0)
+    index = BM25Index(corpus)
+    query = ["term1", "term7", "term7", "missing"]
+    np.testing.assert_allclose(index.get_scores(query), reference_scores(corpus, query), rtol=1e-5)
+
+def test_top_k_matches_full_ranking_without_common_terms():
+    corpus = random_corpus(1)
+    index = BM25Index(corpus, common_term_ratio=1.0)  # No term counts as common
+    for seed in range(20):
+        query = random.Random(seed).sample([f"term{i}" for i in range(60)], 4)
+        scores = index.get_scores(query)
+        doc_ids, top_scores = index.top_k(query, 10)
+        np.testing.assert_allclose(top_scores, np.sort(scores[scores > 0])[::-1][:10], rtol=1e-6)
+        np.testing.assert_allclose(scores[doc_ids], top_scores)
+
+def test_top_k_common_terms_only_rescore_rare_matches():
+    corpus = [["common", "rare"]] * 5 + [["common"]] * 95
+    index = BM25Index(corpus, common_term_ratio=0.5)
+    # Rare term matches enough documents: the common term scores nothing else
+    doc_ids, _ = index.top_k(["common", "rare"], 5)
+    assert sorted(doc_ids.tolist()) == list(range(5))
+    # Too few rare matches for k: the cutoff is skipped
+    doc_ids, _ = index.top_k(["common", "rare"], 10)
+    assert len(doc_ids) == 10 and set(range(5)) <= set(doc_ids.tolist())
+
+def test_top_k_edge_cases():
+    index = BM25Index([["alpha", "beta"], ["beta"], ["gamma"]])
+    assert len(index.top_k(["missing"], 5)[0]) == 0
+    assert len(index.top_k(["beta"], 0)[0]) == 0
+    doc_ids, scores = index.top_k(["beta"], 10)
+    assert sorted(doc_ids.tolist()) == [0, 1] and np.all(np.diff(scores) <= 0)
@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from config import Config
+from hybrid_retriever import HybridRetriever
+
+TEXTS = [
+    "spark-submit runs the application on the cluster",
+    "qdrant stores vectors with payload filters",
+    "bm25 ranks documents by term frequency",
+]
+
+class FakeClient:
+    """Scroll-only stand-in for QdrantClient over an in-memory collection"""
+    def __init__(self, texts):
+        self.points = [
+            SimpleNamespace(id=f"id-{i}", payload={'text': text, 'filename': "doc.pdf", 'chunk_id': i})
+            for i, text in enumerate(texts)
+        ]
+
+    def get_collection(self, collection_name):
+        return SimpleNamespace(points_count=len(self.points))
+
+    def scroll(self, collection_name, limit, offset=None, with_payload=True, with_vectors=False):
+        start = offset or 0
+        next_offset = start + limit if start + limit < len(self.points) else None
+        return self.points[start:start + limit], next_offset
+
+def make_retriever(texts):
+    qdrant_service = SimpleNamespace(client=FakeClient(texts), collection_name="test_docs")
+    return HybridRetriever(qdrant_service, embedding_service=None)
+
+def test_bm25_cache_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'BM25_CACHE_DIR', str(tmp_path))
+    built = make_retriever(TEXTS)
+    if built.bm25_backend != 'bm25s':
+        pytest.skip("only bm25s indexes are persisted")
+    asyncio.run(built.build_bm25_index())
+
+    loaded = make_retriever(TEXTS)
+    assert loaded._load_bm25_cache()
+    assert loaded.documents_metadata == built.documents_metadata
+    assert loaded._keyword_search_sync("qdrant vectors", 2) == built._keyword_search_sync("qdrant vectors", 2)
+
+def test_bm25_cache_misses_changed_collection(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'BM25_CACHE_DIR', str(tmp_path))
+    built = make_retriever(TEXTS)
+    asyncio.run(built.build_bm25_index())
+
+    # Same number of points, different ids: the fingerprint must not match
+    changed = make_retriever(TEXTS)
+    for point in changed.qdrant_service.client.points:
+        point.id += "-new"
+    assert not changed._load_bm25_cache()